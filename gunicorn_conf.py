@@ -0,0 +1,14 @@
+import os
+
+# Zeabur 會提供 PORT
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# 使用 gthread：main.py 自己有背景執行緒池與 asyncio event loop，
+# gevent 的 monkey patch 會讓它們彼此阻塞
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = 60
+
+# 不可 preload：背景執行緒要在各個 worker 行程 import main 時才啟動
+preload_app = False
@@ -1,57 +1,178 @@
 import os
 from flask import Flask, request, abort
+from flask.logging import default_handler
+from logging.handlers import QueueHandler, QueueListener
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration,
     ApiClient,
     MessagingApi,
-    MessagingApiBlob,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    AsyncMessagingApiBlob,
     ReplyMessageRequest,
     PushMessageRequest,
-    TextMessage
+    TextMessage,
+    ApiException
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, AudioMessageContent
 from dotenv import load_dotenv
-from openai import OpenAI
-import tempfile
+from openai import OpenAI, AsyncOpenAI
+import io
+import glob
+import hashlib
+from cachetools import LRUCache, TTLCache
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
 from datetime import datetime, timedelta
-import pytz
-import json
-from typing import Optional, Dict, Any
-from notion_client import Client
+from zoneinfo import ZoneInfo
+import orjson
+import re
+from typing import Optional, Dict, Any, List
+from notion_client import AsyncClient
+import httpx
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+import asyncio
+import threading
+import atexit
+import queue
+import time
+from functools import lru_cache
 
 load_dotenv()
 
 app = Flask(__name__)
 
+# 日誌交給背景執行緒寫到 stderr，webhook 執行緒不必等待 I/O
+log_queue = queue.Queue()
+log_listener = QueueListener(log_queue, default_handler)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(QueueHandler(log_queue))
+app.logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING').upper())
+log_listener.start()
+atexit.register(log_listener.stop)
+
 configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+# 預設連線池大小是 CPU 數 x5；小容器上比 webhook 執行緒少，多出來的連線會被丟棄並重新握手
+configuration.connection_pool_maxsize = 50
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+async_openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+openai_model = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+whisper_language = os.getenv('WHISPER_LANG', 'zh')
+
+# 設定只在啟動時讀取一次
+timezone_name = os.getenv('TIMEZONE', 'Asia/Taipei')
+local_tz = ZoneInfo(timezone_name)
+calendar_credentials_path = os.getenv('GOOGLE_CALENDAR_CREDENTIALS')
+calendar_id = os.getenv('GOOGLE_CALENDAR_ID', 'primary')
+notion_database_id = os.getenv('NOTION_DATABASE_ID')
+
+# Webhook 事件交給背景執行緒處理，callback 可以立即回應 LINE
+webhook_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='webhook')
+
+# 語音 / Notion 等 async I/O 在獨立執行緒的 event loop 上執行
+event_loop = asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, name='asyncio-loop', daemon=True).start()
+
+
+def run_coroutine(coro):
+    """將 coroutine 排入背景 event loop，回傳 concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop)
+
+
+# LINE API clients 共用連線池（keep-alive），不必每次回覆都重新建立 TLS 連線
+api_client = ApiClient(configuration)
+line_bot_api = MessagingApi(api_client)
+
+
+async def create_async_line_clients():
+    """在 event loop 上建立 async LINE clients（aiohttp session 需綁定該 loop）"""
+    async_client = AsyncApiClient(configuration)
+    return async_client, AsyncMessagingApi(async_client), AsyncMessagingApiBlob(async_client)
+
+
+async_api_client, async_line_bot_api, async_line_bot_blob_api = run_coroutine(
+    create_async_line_clients()
+).result()
+
+
+def close_api_clients():
+    api_client.close()
+    run_coroutine(async_api_client.close()).result(timeout=5)
+    if notion_client:
+        run_coroutine(notion_client.aclose()).result(timeout=5)
+
+
+atexit.register(close_api_clients)
+
 
 # Initialize Notion client
+# 語音筆記等待 Notion 的上限（秒），超過就先回覆轉錄結果
+NOTION_REPLY_TIMEOUT = 5
 notion_api_key = os.getenv('NOTION_API_KEY')
-notion_client = Client(auth=notion_api_key) if notion_api_key else None
+# 所有 Notion 請求共用一個 HTTP/2 連線池，多筆筆記同時儲存時可在同一條連線上多工
+notion_client = AsyncClient(
+    auth=notion_api_key,
+    client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+    ),
+    timeout_ms=10_000
+) if notion_api_key else None
+
+# Notion page 不變的部分在 import 時建好（SDK 只讀取不修改，可共用）
+notion_parent = {"database_id": notion_database_id}
+notion_type_properties = {
+    note_type: {"select": {"name": note_type}}
+    for note_type in ("語音筆記", "文字筆記")
+}
 
 
 # Initialize Google Calendar service
 def get_calendar_service():
-    credentials_path = os.getenv('GOOGLE_CALENDAR_CREDENTIALS')
-    if not credentials_path:
+    if not calendar_credentials_path:
         return None
 
     # Check if file exists
-    if not os.path.exists(credentials_path):
-        app.logger.warning(f"Google Calendar credentials file not found: {credentials_path}")
+    if not os.path.exists(calendar_credentials_path):
+        app.logger.warning(f"Google Calendar credentials file not found: {calendar_credentials_path}")
         return None
 
-    credentials = service_account.Credentials.from_service_account_file(
-        credentials_path,
+    # 使用套件內建的 discovery 文件，不在啟動時抓取
+    return build(
+        'calendar', 'v3',
+        credentials=load_calendar_credentials(),
+        cache_discovery=False,
+        static_discovery=True
+    )
+
+
+@lru_cache(maxsize=1)
+def load_calendar_credentials():
+    """讀取 service account 金鑰（只解析一次）"""
+    return service_account.Credentials.from_service_account_file(
+        calendar_credentials_path,
         scopes=['https://www.googleapis.com/auth/calendar']
     )
-    return build('calendar', 'v3', credentials=credentials)
+
+
+# httplib2 不是 thread-safe，每個執行緒各自保留一個 authorized http 重複使用連線
+calendar_http = threading.local()
+# httplib2 預設沒有逾時；連線卡住會讓 calendar-batch 執行緒永遠等下去，需短於 add_calendar_event 的等待
+CALENDAR_HTTP_TIMEOUT = 20
+
+
+def get_calendar_http():
+    if not hasattr(calendar_http, 'http'):
+        calendar_http.http = google_auth_httplib2.AuthorizedHttp(
+            load_calendar_credentials(),
+            http=httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT)
+        )
+    return calendar_http.http
 
 
 try:
@@ -65,94 +186,176 @@ except Exception as e:
     app.logger.error(f"Failed to initialize Google Calendar: {str(e)}")
 
 
-def parse_calendar_event(text: str) -> Optional[Dict[str, Any]]:
-    """使用 OpenAI 解析訊息中的行事曆事件"""
-    tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Taipei'))
-    now = datetime.now(tz)
+# 短時間內的多筆行事曆新增合併成一個 batch request（Google 上限 50 筆）
+CALENDAR_BATCH_WINDOW = 0.15
+CALENDAR_BATCH_MAX = 50
+# add_calendar_event 等待 batch 結果的上限（秒），需長於 CALENDAR_HTTP_TIMEOUT
+CALENDAR_INSERT_TIMEOUT = 30
+calendar_insert_queue = queue.Queue()
+
+
+def insert_calendar_event(event: Dict[str, Any]) -> Future:
+    """將事件排入 batch 佇列，回傳的 Future 會得到 API 建立的事件"""
+    future = Future()
+    calendar_insert_queue.put((event, future))
+    return future
+
+
+def calendar_batch_worker():
+    """收集 CALENDAR_BATCH_WINDOW 內排入的事件後一次送出"""
+    while True:
+        pending = [calendar_insert_queue.get()]
+        deadline = time.monotonic() + CALENDAR_BATCH_WINDOW
+        while len(pending) < CALENDAR_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(calendar_insert_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        execute_calendar_inserts(pending)
+
+
+def execute_calendar_inserts(pending):
+    """執行一批行事曆新增，結果寫回各自的 Future"""
+    # 等待逾時而被取消的事件不再送出，避免使用者重試後出現重複事件
+    pending = [(event, future) for event, future in pending if future.set_running_or_notify_cancel()]
+    if not pending:
+        return
 
-    system_message = f"""你是智能行事曆助手。今天：{now.strftime('%Y-%m-%d %A %H:%M')}
+    try:
+        if len(pending) == 1:
+            event, future = pending[0]
+            future.set_result(calendar_service.events().insert(
+                calendarId=calendar_id,
+                body=event
+            ).execute(http=get_calendar_http()))
+            return
+
+        def on_inserted(request_id, response, exception):
+            future = pending[int(request_id)][1]
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(response)
+
+        batch = calendar_service.new_batch_http_request(callback=on_inserted)
+        for index, (event, _) in enumerate(pending):
+            batch.add(
+                calendar_service.events().insert(calendarId=calendar_id, body=event),
+                request_id=str(index)
+            )
+        batch.execute(http=get_calendar_http())
+    except Exception as e:
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(e)
+
+
+if calendar_service:
+    threading.Thread(target=calendar_batch_worker, name='calendar-batch', daemon=True).start()
+
+
+# 行事曆關鍵字：沒有命中的訊息不送 GPT 解析
+CALENDAR_HINT_PATTERN = re.compile(
+    r'(今天|明天|後天|下週|下星期|下禮拜|星期[一二三四五六日天]|週[一二三四五六日]|禮拜[一二三四五六日天]'
+    r'|[上下]午|早上|中午|晚上|\d{1,2}\s*[點:：]|[一二兩三四五六七八九十]{1,3}\s*點|\d{1,2}[/月]\d{1,2}'
+    r'|開會|會議|提醒|預約)'
+)
+
+
+# 行事曆解析的 system prompt 只有目前時間會變動，其餘在 import 時建好
+CALENDAR_SYSTEM_TEMPLATE = """你是智能行事曆助手。今天：__NOW__
 
 相對時間：
 - 明天 = 今天 + 1天
 - 下週一 = 下個星期一
 - 下午3點 = 15:00
 
-如果訊息不包含事件，回應 null。
+如果訊息不包含事件，has_event 為 false。
 如果包含事件，提取標題、時間（ISO 8601格式）。
-未指定結束時間則預設1小時。"""
-
-    tools = [{
-        "type": "function",
-        "function": {
-            "name": "create_calendar_event",
-            "description": "Create calendar event",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "has_event": {"type": "boolean"},
-                    "title": {"type": "string"},
-                    "start_time": {"type": "string"},
-                    "end_time": {"type": "string"},
-                    "location": {"type": "string"}
-                },
-                "required": ["has_event"]
-            }
-        }
-    }]
+未指定結束時間則預設1小時。
 
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": text}
-            ],
-            tools=tools,
-            tool_choice="auto"
-        )
+回傳 JSON：{"has_event": boolean, "title": string, "start_time": string, "end_time": string, "location": string}"""
+CALENDAR_RESPONSE_FORMAT = {"type": "json_object"}
 
-        tool_calls = response.choices[0].message.tool_calls
-        if not tool_calls:
-            return None
+# prompt 只需要分鐘精度，格式化後的時間字串每分鐘更新一次
+now_string_cache = [0, ""]
 
-        args = json.loads(tool_calls[0].function.arguments)
-        if not args.get('has_event'):
-            return None
 
-        return {
-            'title': args['title'],
-            'start_time': args['start_time'],
-            'end_time': args['end_time'],
-            'location': args.get('location')
-        }
+def current_time_string() -> str:
+    minute = int(time.time() // 60)
+    if minute != now_string_cache[0]:
+        now_string_cache[:] = [minute, datetime.now(local_tz).strftime('%Y-%m-%d %A %H:%M')]
+    return now_string_cache[1]
+
+
+def parse_calendar_event(text: str) -> Optional[Dict[str, Any]]:
+    """使用 OpenAI 解析訊息中的行事曆事件"""
+    try:
+        # 以小時為單位快取，「明天」等相對時間不會沿用太舊的結果
+        return parse_calendar_event_cached(text, int(time.time() // 3600))
     except Exception as e:
         app.logger.error(f"Parse event error: {str(e)}")
         return None
 
 
+def calendar_messages(text: str) -> List[Dict[str, str]]:
+    """組出行事曆解析用的 chat messages"""
+    system_message = CALENDAR_SYSTEM_TEMPLATE.replace('__NOW__', current_time_string())
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": text}
+    ]
+
+
+@lru_cache(maxsize=4096)
+def parse_calendar_event_cached(text: str, hour_bucket: int) -> Optional[Dict[str, Any]]:
+    """同一小時內重複的訊息（例如 LINE 重送）直接回傳快取結果；錯誤會拋出而不進快取"""
+    response = openai_client.chat.completions.create(
+        model=openai_model,
+        messages=calendar_messages(text),
+        response_format=CALENDAR_RESPONSE_FORMAT
+    )
+    return calendar_event_from_content(response.choices[0].message.content)
+
+
+def calendar_event_from_content(content: str) -> Optional[Dict[str, Any]]:
+    """將模型回傳的 JSON 轉為事件資料，沒有事件時回傳 None"""
+    args = orjson.loads(content)
+    if not args.get('has_event'):
+        return None
+
+    return {
+        'title': args['title'],
+        'start_time': args['start_time'],
+        'end_time': args['end_time'],
+        'location': args.get('location')
+    }
+
+
 def add_calendar_event(event_data: Dict[str, Any]) -> Dict[str, str]:
     """新增事件到 Google Calendar"""
     try:
-        tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Taipei'))
-
         # 解析時間並加上時區
         start_dt = datetime.fromisoformat(event_data['start_time'])
         end_dt = datetime.fromisoformat(event_data['end_time'])
 
         if start_dt.tzinfo is None:
-            start_dt = tz.localize(start_dt)
+            start_dt = start_dt.replace(tzinfo=local_tz)
         if end_dt.tzinfo is None:
-            end_dt = tz.localize(end_dt)
+            end_dt = end_dt.replace(tzinfo=local_tz)
 
         event = {
             'summary': event_data['title'],
             'start': {
                 'dateTime': start_dt.isoformat(),
-                'timeZone': os.getenv('TIMEZONE', 'Asia/Taipei'),
+                'timeZone': timezone_name,
             },
             'end': {
                 'dateTime': end_dt.isoformat(),
-                'timeZone': os.getenv('TIMEZONE', 'Asia/Taipei'),
+                'timeZone': timezone_name,
             },
             'reminders': {'useDefault': True}
         }
@@ -160,11 +363,13 @@ def add_calendar_event(event_data: Dict[str, Any]) -> Dict[str, str]:
         if event_data.get('location'):
             event['location'] = event_data['location']
 
-        calendar_id = os.getenv('GOOGLE_CALENDAR_ID', 'primary')
-        created = calendar_service.events().insert(
-            calendarId=calendar_id,
-            body=event
-        ).execute()
+        future = insert_calendar_event(event)
+        try:
+            created = future.result(timeout=CALENDAR_INSERT_TIMEOUT)
+        except FutureTimeoutError:
+            if future.cancel():
+                return {'success': False, 'error': 'Google Calendar 忙碌中，已取消這次新增，請稍後再試'}
+            return {'success': False, 'error': 'Google Calendar 回應逾時，事件可能已建立，重試前請先確認行事曆'}
 
         return {
             'success': True,
@@ -178,14 +383,67 @@ def add_calendar_event(event_data: Dict[str, Any]) -> Dict[str, str]:
         return {'success': False, 'error': str(e)}
 
 
-def process_message_for_calendar(text: str, reply_token: str) -> bool:
+def reply_text_message(event, text: str):
+    """回覆文字訊息，reply token 過期（400）時改用 push message"""
+    messages = [TextMessage(text=text)]
+    try:
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=messages
+            )
+        )
+    except ApiException as e:
+        # 只有 reply token 過期 / 無效（400）才改用 push；429、5xx 時回覆可能已送達，改推播會重複且計費
+        user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
+        if e.status != 400 or not user_id:
+            raise
+        app.logger.warning(f"Reply failed (status {e.status}), falling back to push message")
+        line_bot_api.push_message_with_http_info(
+            PushMessageRequest(
+                to=user_id,
+                messages=messages
+            )
+        )
+
+
+async def async_reply_text_message(event, text: str):
+    """reply_text_message 的 async 版本，供 event loop 上的 handler 使用"""
+    messages = [TextMessage(text=text)]
+    try:
+        await async_line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=messages
+            )
+        )
+    except ApiException as e:
+        # 只有 reply token 過期 / 無效（400）才改用 push；429、5xx 時回覆可能已送達，改推播會重複且計費
+        user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
+        if e.status != 400 or not user_id:
+            raise
+        app.logger.warning(f"Reply failed (status {e.status}), falling back to push message")
+        await async_line_bot_api.push_message_with_http_info(
+            PushMessageRequest(
+                to=user_id,
+                messages=messages
+            )
+        )
+
+
+def process_message_for_calendar(text: str, event) -> bool:
     """處理訊息並建立行事曆事件"""
     event_data = parse_calendar_event(text)
     if not event_data:
         return False
 
     result = add_calendar_event(event_data)
+    reply_text_message(event, format_calendar_reply(result))
+    return True
 
+
+def format_calendar_reply(result: Dict[str, Any]) -> str:
+    """將 add_calendar_event 的結果轉為回覆文字"""
     if result['success']:
         message = f"✅ 已新增行事曆事件！\n\n"
         message += f"標題：{result['summary']}\n"
@@ -193,30 +451,169 @@ def process_message_for_calendar(text: str, reply_token: str) -> bool:
         message += f"連結：{result['event_link']}"
     else:
         message = f"❌ 新增行事曆失敗\n錯誤：{result['error']}"
+    return message
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=message)]
+
+def push_text_message(user_id: str, text: str):
+    """主動推播文字訊息（沒有 reply token 時使用），失敗只記錄"""
+    try:
+        line_bot_api.push_message_with_http_info(
+            PushMessageRequest(
+                to=user_id,
+                messages=[TextMessage(text=text)]
             )
         )
-    return True
+    except ApiException as e:
+        app.logger.error(f"Push message error (status {e.status}): {str(e)}")
+
+
+# 使用者明確表示不急的行程改走 OpenAI Batch API（半價），完成後以 push 通知
+# 只比對「排行程」的明確說法，「不急啦」、「有空再聊」等閒聊不算
+DEFERRED_CALENDAR_PATTERN = re.compile(r'(慢慢排|有空再排|不急著排|不用急著排|明天以後再排)')
+OPENAI_BATCH_INTERVAL = int(os.getenv('OPENAI_BATCH_INTERVAL', 300))
+# 佇列與進行中的 batch 都存成檔案，重啟或重新部署後可以接續（目錄需放在持久化 volume 上）
+# gunicorn 的多個 worker 共用同一個目錄，以 os.replace 搶到檔案的行程負責處理
+OPENAI_BATCH_DIR = os.getenv('OPENAI_BATCH_DIR', 'openai-batches')
+deferred_calendar_queue_path = os.path.join(OPENAI_BATCH_DIR, 'queue.jsonl')
+deferred_calendar_lock = threading.Lock()
+
+
+def queue_deferred_calendar_event(text: str, user_id: str):
+    """寫入佇列檔，下一次的 OpenAI batch 一起送出"""
+    line = orjson.dumps({"user_id": user_id, "messages": calendar_messages(text)}) + b"\n"
+    with deferred_calendar_lock, open(deferred_calendar_queue_path, 'ab') as f:
+        f.write(line)
+
+
+def openai_batch_worker():
+    """每 OPENAI_BATCH_INTERVAL 秒送出累積的請求並檢查進行中的 batch"""
+    while True:
+        time.sleep(OPENAI_BATCH_INTERVAL)
+        try:
+            submit_openai_batch()
+        except Exception as e:
+            app.logger.error(f"Submit OpenAI batch error: {str(e)}")
+        for batch_path in glob.glob(os.path.join(OPENAI_BATCH_DIR, '*.batch')):
+            try:
+                poll_openai_batch(batch_path)
+            except Exception as e:
+                app.logger.error(f"Poll OpenAI batch error: {str(e)}")
+
+
+def submit_openai_batch():
+    """將佇列檔中的請求上傳並建立 batch"""
+    claimed_path = f"{deferred_calendar_queue_path}.{os.getpid()}"
+    with deferred_calendar_lock:
+        try:
+            os.replace(deferred_calendar_queue_path, claimed_path)
+        except FileNotFoundError:
+            return
+    with open(claimed_path, 'rb') as f:
+        queued = f.read()
+    pending = [orjson.loads(line) for line in queued.splitlines() if line.strip()]
+    if not pending:
+        os.remove(claimed_path)
+        return
+
+    # custom_id 帶著 user id，結果本身就能對應到使用者
+    lines = [
+        orjson.dumps({
+            "custom_id": f"{item['user_id']}:{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": openai_model,
+                "messages": item['messages'],
+                "response_format": CALENDAR_RESPONSE_FORMAT
+            }
+        })
+        for index, item in enumerate(pending)
+    ]
+    try:
+        input_file = openai_client.files.create(
+            file=("calendar-batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except Exception:
+        # 上傳失敗就放回佇列，下一輪再試
+        with deferred_calendar_lock, open(deferred_calendar_queue_path, 'ab') as f:
+            f.write(queued)
+        os.remove(claimed_path)
+        raise
+
+    with open(os.path.join(OPENAI_BATCH_DIR, f"{batch.id}.batch"), 'wb') as f:
+        f.write(orjson.dumps([item['user_id'] for item in pending]))
+    os.remove(claimed_path)
+
+
+def poll_openai_batch(batch_path: str):
+    """batch 完成後建立行事曆事件並通知使用者"""
+    batch_id = os.path.basename(batch_path)[:-len('.batch')]
+    batch = openai_client.batches.retrieve(batch_id)
+    if batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        return
+
+    # 搶到檔案的 worker 才處理，避免重複建立事件；下載或解析結果失敗時，finally 仍會通知尚未收到結果的使用者
+    claimed_path = f"{batch_path}.{os.getpid()}"
+    try:
+        os.replace(batch_path, claimed_path)
+    except FileNotFoundError:
+        return
+    with open(claimed_path, 'rb') as f:
+        user_ids = orjson.loads(f.read())
+
+    notified = set()
+    failure = batch.status
+    try:
+        if batch.status == 'completed' and batch.output_file_id:
+            output = openai_client.files.content(batch.output_file_id).text
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                custom_id = item['custom_id']
+                try:
+                    body = item['response']['body']
+                    event_data = calendar_event_from_content(body['choices'][0]['message']['content'])
+                except Exception as e:
+                    app.logger.error(f"Parse batch result error: {str(e)}")
+                    continue
+                notified.add(custom_id)
+                if event_data:
+                    message = format_calendar_reply(add_calendar_event(event_data))
+                else:
+                    message = "🤔 沒有找到可以加入行事曆的事件"
+                push_text_message(custom_id.rsplit(':', 1)[0], message)
+    except Exception:
+        failure = 'error'
+        raise
+    finally:
+        for index, user_id in enumerate(user_ids):
+            if f"{user_id}:{index}" not in notified:
+                push_text_message(user_id, f"❌ 行事曆批次處理失敗（{failure}）")
+        os.remove(claimed_path)
+
 
+if calendar_service:
+    os.makedirs(OPENAI_BATCH_DIR, exist_ok=True)
+    threading.Thread(target=openai_batch_worker, name='openai-batch', daemon=True).start()
 
-def save_to_notion(transcription: str, note_type: str = "語音筆記", user_id: str = None) -> Dict[str, Any]:
+
+async def save_to_notion(transcription: str, note_type: str = "語音筆記", user_id: str = None) -> Dict[str, Any]:
     """將內容儲存到 Notion database"""
     if not notion_client:
         return {'success': False, 'error': 'Notion client not initialized'}
 
     try:
-        database_id = os.getenv('NOTION_DATABASE_ID')
-        if not database_id:
+        if not notion_database_id:
             return {'success': False, 'error': 'NOTION_DATABASE_ID not set'}
 
-        tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Taipei'))
-        now = datetime.now(tz)
+        now = datetime.now(local_tz)
 
         # Create page in Notion database
         properties = {
@@ -224,7 +621,7 @@ def save_to_notion(transcription: str, note_type: str = "語音筆記", user_id:
                 "title": [
                     {
                         "text": {
-                            "content": transcription[:100] if len(transcription) > 0 else "空白內容"
+                            "content": transcription[:100] or "空白內容"
                         }
                     }
                 ]
@@ -243,15 +640,11 @@ def save_to_notion(transcription: str, note_type: str = "語音筆記", user_id:
                     "start": now.isoformat()
                 }
             },
-            "類型": {
-                "select": {
-                    "name": note_type
-                }
-            }
+            "類型": notion_type_properties.get(note_type) or {"select": {"name": note_type}}
         }
 
-        response = notion_client.pages.create(
-            parent={"database_id": database_id},
+        response = await notion_client.pages.create(
+            parent=notion_parent,
             properties=properties
         )
 
@@ -265,23 +658,59 @@ def save_to_notion(transcription: str, note_type: str = "語音筆記", user_id:
         return {'success': False, 'error': str(e)}
 
 
+def format_notion_reply(notion_result: Dict[str, Any]) -> str:
+    """將 save_to_notion 的結果轉為回覆文字"""
+    if notion_result['success']:
+        return f"📝 已儲存到 Notion\n{notion_result['url']}"
+    return f"⚠️ Notion 儲存失敗: {notion_result['error']}"
+
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    app.logger.debug("Request body: %s", body)
 
+    if not handler.parser.signature_validator.validate(body, signature):
+        app.logger.warning("Invalid signature. Please check your channel access token/channel secret.")
+        abort(400)
+
+    # 簽章驗證通過後即回應，事件處理（OpenAI / Notion / Calendar）在背景進行
+    webhook_executor.submit(handle_webhook, body, signature)
+    return 'OK'
+
+
+def handle_webhook(body: str, signature: str):
+    """在背景執行緒分派 webhook 事件"""
+    # handler.handle 會再驗證一次簽章：SDK 沒有公開「只分派不驗證」的介面，
+    # 自行分派得依賴其私有方法；HMAC-SHA256 只需數微秒，保留重複驗證
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
-        app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
-        abort(400)
+        app.logger.warning("Invalid signature. Please check your channel access token/channel secret.")
+    except Exception as e:
+        app.logger.error(f"Webhook handling error: {str(e)}")
 
-    return 'OK'
+
+# LINE 可能重送同一則訊息，10 分鐘內看過的 message id 直接略過
+seen_message_ids = TTLCache(maxsize=50_000, ttl=600)
+seen_message_ids_lock = threading.Lock()
+
+
+def is_duplicate_message(event) -> bool:
+    """檢查訊息是否已處理過（並記錄為已處理）"""
+    with seen_message_ids_lock:
+        if event.message.id in seen_message_ids:
+            return True
+        seen_message_ids[event.message.id] = True
+        return False
 
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
+    if is_duplicate_message(event):
+        return
+
     text = event.message.text
 
     # 檢查是否以 /a 開頭（儲存到 Notion）
@@ -290,104 +719,137 @@ def handle_message(event):
 
         if notion_client and content:
             user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
-            notion_result = save_to_notion(content, note_type="文字筆記", user_id=user_id)
-
-            if notion_result['success']:
-                reply_text = f"📝 已儲存到 Notion\n{notion_result['url']}"
-            else:
-                reply_text = f"⚠️ Notion 儲存失敗: {notion_result['error']}"
+            notion_result = run_coroutine(
+                save_to_notion(content, note_type="文字筆記", user_id=user_id)
+            ).result()
+            reply_text = format_notion_reply(notion_result)
         else:
             reply_text = "❌ Notion 未設定或內容為空"
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)]
-                )
-            )
+        reply_text_message(event, reply_text)
+        return
+
+    # 不急的行程排入批次處理，先回覆收到
+    user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
+    if (calendar_service and user_id and DEFERRED_CALENDAR_PATTERN.search(text)
+            and CALENDAR_HINT_PATTERN.search(text)):
+        queue_deferred_calendar_event(text, user_id)
+        reply_text_message(event, "🕒 已排入行事曆批次處理，完成後會通知你")
         return
 
-    # 先嘗試處理為行事曆事件
-    if calendar_service and process_message_for_calendar(text, event.reply_token):
+    # 先嘗試處理為行事曆事件（有時間 / 行程關鍵字才呼叫 GPT）
+    if (calendar_service and CALENDAR_HINT_PATTERN.search(text)
+            and process_message_for_calendar(text, event)):
         return
 
     # 不是事件，echo 回去
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=text)]
-            )
-        )
+    reply_text_message(event, text)
 
 
 @handler.add(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event):
+    if is_duplicate_message(event):
+        return
+
+    # 語音處理交給 event loop，webhook 執行緒不必等待下載與轉錄
+    future = run_coroutine(handle_audio_message_async(event))
+    future.add_done_callback(log_future_error)
+
+
+def log_future_error(future):
+    """記錄背景 coroutine 未處理的例外"""
+    if not future.cancelled() and future.exception():
+        app.logger.error(f"Background task error: {str(future.exception())}")
+
+
+# 短於此長度的語音多半是誤觸，不送 Whisper
+MIN_AUDIO_DURATION_MS = 1000
+MIN_AUDIO_BYTES = 8_000
+SHORT_AUDIO_REPLY = "🎤 語音太短，請再錄一次"
+
+# 以音訊內容雜湊快取轉錄結果，重送或轉傳同一段語音時不必再呼叫 Whisper
+# （只在 event loop 執行緒上存取，不需要鎖）
+transcription_cache = LRUCache(maxsize=2048)
+
+
+async def transcribe_audio(audio_content: bytes, message_id: str) -> str:
+    """使用 OpenAI Whisper 將語音轉為文字"""
+    key = hashlib.blake2b(audio_content, digest_size=16).digest()
+    if key in transcription_cache:
+        return transcription_cache[key]
+
+    # Whisper 接受 file-like 物件，直接從記憶體上傳（檔名決定音訊格式）
+    audio_file = io.BytesIO(audio_content)
+    audio_file.name = f"{message_id}.m4a"
+
+    transcription = await async_openai_client.audio.transcriptions.create(
+        model="whisper-1",
+        file=audio_file,
+        response_format="text",
+        language=whisper_language,
+        temperature=0
+    )
+    transcription_cache[key] = transcription
+    return transcription
+
+
+async def handle_audio_message_async(event):
     try:
         message_id = event.message.id
 
+        # LINE 會附上語音長度，太短就不用下載
+        duration = event.message.duration
+        if duration is not None and duration < MIN_AUDIO_DURATION_MS:
+            await async_reply_text_message(event, SHORT_AUDIO_REPLY)
+            return
+
         # Download audio content from LINE
-        with ApiClient(configuration) as api_client:
-            line_bot_blob_api = MessagingApiBlob(api_client)
-            audio_content = line_bot_blob_api.get_message_content(message_id)
+        audio_content = await async_line_bot_blob_api.get_message_content(message_id)
+        # 沒有長度資訊時才以檔案大小判斷（低位元率的正常語音也可能小於 MIN_AUDIO_BYTES）
+        if duration is None and len(audio_content) < MIN_AUDIO_BYTES:
+            await async_reply_text_message(event, SHORT_AUDIO_REPLY)
+            return
 
-        # Create temporary file for audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.m4a') as temp_audio:
-            temp_audio.write(audio_content)
-            temp_audio_path = temp_audio.name
+        # Transcribe audio using OpenAI Whisper
+        transcription = await transcribe_audio(audio_content, message_id)
 
-        try:
-            # Transcribe audio using OpenAI Whisper
-            with open(temp_audio_path, 'rb') as audio_file:
-                transcription = openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="text"
-                )
-
-            # 語音訊息自動儲存到 Notion
-            content = transcription.strip()
-
-            if notion_client and content:
-                user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
-                notion_result = save_to_notion(content, note_type="語音筆記", user_id=user_id)
-
-                if notion_result['success']:
-                    reply_text = f"📝 已儲存到 Notion\n{notion_result['url']}"
-                else:
-                    reply_text = f"⚠️ Notion 儲存失敗: {notion_result['error']}"
-            else:
-                reply_text = f"🎤 語音轉錄：\n{content}"
-
-            # 回覆轉錄結果
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)]
+        # 語音訊息自動儲存到 Notion
+        content = transcription.strip()
+
+        if notion_client and content:
+            user_id = event.source.user_id if hasattr(event.source, 'user_id') else None
+            notion_task = asyncio.create_task(
+                save_to_notion(content, note_type="語音筆記", user_id=user_id)
+            )
+            done, _ = await asyncio.wait({notion_task}, timeout=NOTION_REPLY_TIMEOUT)
+
+            if not done and user_id:
+                # Notion 回應太慢：先回覆轉錄結果，儲存完成後再以 push 通知
+                await async_reply_text_message(event, f"🎤 語音轉錄：\n{content}\n\n⏳ 正在儲存到 Notion…")
+                notion_result = await notion_task
+                # 轉錄已經回覆成功，push 失敗只記錄，不能再回覆「轉文字失敗」
+                try:
+                    await async_line_bot_api.push_message_with_http_info(
+                        PushMessageRequest(
+                            to=user_id,
+                            messages=[TextMessage(text=format_notion_reply(notion_result))]
+                        )
                     )
-                )
-        finally:
-            # Clean up temporary file
-            import os as os_module
-            if os_module.path.exists(temp_audio_path):
-                os_module.unlink(temp_audio_path)
+                except Exception as e:
+                    app.logger.error(f"Push Notion result error: {str(e)}")
+                return
+
+            reply_text = format_notion_reply(await notion_task)
+        else:
+            reply_text = f"🎤 語音轉錄：\n{content}"
+
+        # 回覆轉錄結果（處理時間較長，reply token 可能已過期）
+        await async_reply_text_message(event, reply_text)
 
     except Exception as e:
         # Log error and send user-friendly message
         app.logger.error(f"Error processing audio message: {str(e)}")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="抱歉，語音轉文字時發生錯誤。\nSorry, an error occurred during transcription.")]
-                )
-            )
+        await async_reply_text_message(event, "抱歉，語音轉文字時發生錯誤。\nSorry, an error occurred during transcription.")
 
 
 if __name__ == "__main__":